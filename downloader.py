@@ -1,159 +1,467 @@
-import os
-import asyncio
-import logging
-import httpx
-from pathvalidate import sanitize_filename, sanitize_filepath
-import aiofiles
-from qobuz_client import QobuzClient
-import metadata_utils
-
-logger = logging.getLogger(__name__)
-
-class QobuzDownloader:
-    def __init__(self, client: QobuzClient, download_base_path="./downloads", quality=6):
-        self.client = client
-        self.base_path = download_base_path
-        self.quality = quality
-        os.makedirs(self.base_path, exist_ok=True)
-
-    async def download_track(self, track_id, album_data=None, folder_path=None, pbar_callback=None):
-        """Download a single track."""
-        if not album_data:
-            track_meta = await self.client.get_track(track_id)
-            album_data = track_meta["album"]
-            track_data = track_meta
-        else:
-            # When downloading as part of an album, we might already have album data
-            # but we need specific track url and meta
-            track_data = await self.client.get_track(track_id)
-
-        # Get download URL
-        file_info = await self.client.get_file_url(track_id, self.quality)
-        url = file_info.get("url")
-        if not url:
-            raise Exception("No download URL available. It might be a demo or restricted.")
-
-        # Prepare paths
-        artist_name = album_data["artist"]["name"]
-        album_title = album_data["title"]
-        year = album_data.get("release_date_original", "").split("-")[0]
-        
-        if not folder_path:
-            folder_name = sanitize_filename(f"{artist_name} - {album_title} ({year})")
-            folder_path = os.path.join(self.base_path, folder_name)
-        
-        os.makedirs(folder_path, exist_ok=True)
-
-        is_mp3 = int(self.quality) == 5
-        extension = ".mp3" if is_mp3 else ".flac"
-        
-        track_number = f"{track_data['track_number']:02}"
-        track_title = metadata_utils.get_title(track_data)
-        filename = sanitize_filename(f"{track_number}. {track_title}{extension}")
-        final_path = os.path.join(folder_path, filename)
-
-        if os.path.exists(final_path):
-            logger.info(f"File already exists: {filename}")
-            return final_path
-
-        # Temp
-        tmp_path = final_path + ".tmp"
-        
-        # Download cover if not exists
-        cover_path = await self._download_cover(album_data, folder_path)
-
-        # Start download
-        async with httpx.AsyncClient() as client:
-            async with client.stream("GET", url) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get("content-length", 0))
-                downloaded = 0
-                
-                async with aiofiles.open(tmp_path, "wb") as f:
-                    async for chunk in response.aiter_bytes(chunk_size=1024*64):
-                        await f.write(chunk)
-                        downloaded += len(chunk)
-                        if pbar_callback:
-                            await pbar_callback(downloaded, total_size, filename)
-
-        # Prepare thumbnail
-        thumb_path = os.path.join(folder_path, "thumb.jpg")
-        if os.path.exists(thumb_path):
-            try: os.remove(thumb_path)
-            except: pass
-
-        try:
-            thumb_path = metadata_utils.create_thumbnail(cover_path)
-        except Exception as e:
-            logger.warning(f"Failed to create thumbnail: {e}")
-            thumb_path = None
-
-        # Tagging (this is blocking, so run in executor if needed, but for small-ish files it's fine)
-        await asyncio.to_thread(
-            metadata_utils.tag_mp3 if is_mp3 else metadata_utils.tag_flac,
-            tmp_path, final_path, track_data, album_data, cover_path
-        )
-        
-        caption = metadata_utils.get_audio_info(final_path)
-        
-        player_info = {
-            "title": track_title,
-            "performer": artist_name,
-            "duration": track_data.get("duration"),
-            "cover": cover_path,
-            "thumbnail": thumb_path,
-            "folder_path": folder_path
-        }
-        
-        return final_path, caption, player_info
-
-    async def _download_cover(self, album_data, folder_path):
-        cover_path = os.path.join(folder_path, "cover.jpg")
-        if os.path.exists(cover_path):
-            return cover_path
-            
-        base_url = album_data["image"]["large"] # Usually 600x600
-        # List of URLs to try in order of preference
-        urls_to_try = [
-            base_url.replace("_600.jpg", "_org.jpg"),  # Original
-            base_url,                                  # 600px
-            album_data["image"]["small"]               # fallback
-        ]
-        
-        async with httpx.AsyncClient() as client:
-            for url in urls_to_try:
-                if not url: continue
-                try:
-                    resp = await client.get(url, timeout=10.0)
-                    if resp.status_code == 200:
-                        async with aiofiles.open(cover_path, "wb") as f:
-                            await f.write(resp.content)
-                        logger.info(f"Downloaded cover art: {url}")
-                        return cover_path
-                except Exception as e:
-                    logger.debug(f"Failed to download cover from {url}: {e}")
-        
-        logger.warning("Failed to download any cover art")
-        return None
-
-    async def download_album(self, album_id, pbar_callback=None):
-        """Download an entire album."""
-        album_data = await self.client.get_album(album_id)
-        tracks = album_data["tracks"]["items"]
-        
-        artist_name = album_data["artist"]["name"]
-        album_title = album_data["title"]
-        year = album_data.get("release_date_original", "").split("-")[0]
-        folder_name = sanitize_filename(f"{artist_name} - {album_title} ({year})")
-        folder_path = os.path.join(self.base_path, folder_name)
-        
-        downloaded_data = []
-        for i, track in enumerate(tracks):
-            try:
-                # We can update the progress bar to show overall progress too
-                result = await self.download_track(track["id"], album_data, folder_path, pbar_callback)
-                downloaded_data.append(result)
-            except Exception as e:
-                logger.error(f"Failed to download track {track['title']}: {e}")
-        
-        return downloaded_data
+import os
+import re
+import asyncio
+import collections
+import contextlib
+import logging
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+import certifi
+import httpx
+from pathvalidate import sanitize_filename, sanitize_filepath
+import aiofiles
+from qobuz_client import QobuzClient
+import metadata_utils
+
+logger = logging.getLogger(__name__)
+
+_CACHE_SIZE = 256
+_COVER_CACHE_SIZE = 16  # original covers can be several MB each
+_CHUNK_SIZE = 1024 * 1024
+_PROGRESS_INTERVAL = 0.5  # seconds
+_PROGRESS_BYTES = 2 * 1024 * 1024
+_O_BINARY = getattr(os, "O_BINARY", 0)  # Windows only
+# Loading the CA bundle is expensive, do it once per process
+_SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+_UNSAFE_FILENAME_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1f\x7f]')
+# Anything starting like a Windows device name goes to pathvalidate, its reserved-name
+# handling has quirks ("nul " -> "nul", "con." -> "con_.") not worth copying here
+_RESERVED_PREFIXES = ("CON", "PRN", "AUX", "NUL", "COM", "LPT", "CLOCK$")
+
+def _sanitize_filename(name):
+    """Same result as pathvalidate's sanitize_filename, without its overhead for plain ASCII names."""
+    if not name.isascii() or len(name) > 255:
+        return sanitize_filename(name)
+    name = _UNSAFE_FILENAME_CHARS.sub("", name)
+    if name in ("", ".", "..") or name.upper().startswith(_RESERVED_PREFIXES):
+        return sanitize_filename(name)
+    # Windows: no leading space, no trailing space or period
+    name = name.strip(" ")
+    if name not in (".", ".."):
+        name = name.rstrip(" .")
+    return name
+
+def _write_all(fd, data):
+    """os.write may write less than asked, keep going until the chunk is on disk."""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+def _range_total(response):
+    """Full file size from a `Content-Range: bytes a-b/total` header, if present."""
+    _, _, total = response.headers.get("content-range", "").rpartition("/")
+    return int(total) if total.isdigit() else None
+
+class _BufferPool:
+    """Free-list of fixed-size bytearrays reused across track downloads."""
+
+    def __init__(self, size=_CHUNK_SIZE, max_free=16):
+        self.size = size
+        self.max_free = max_free
+        self._free = collections.deque()
+
+    def acquire(self):
+        return self._free.pop() if self._free else bytearray(self.size)
+
+    def release(self, buf):
+        if len(self._free) < self.max_free:
+            self._free.append(buf)
+
+class _FileWriter:
+    """Writes a downloaded stream to disk on a dedicated thread.
+
+    Incoming chunks are copied into pooled buffers and each full buffer is
+    handed to the thread without waiting for the previous write, so reading
+    from the network overlaps with writing to disk. At most `depth` writes are
+    in flight, which bounds the memory held.
+    """
+
+    def __init__(self, path, pool: _BufferPool, depth=2, append=False):
+        self.path = path
+        self.append = append
+        self.pool = pool
+        self.depth = depth
+        self._fd = None
+        self._executor = None
+        self._pending = collections.deque()
+        self._buf = None
+        self._fill = 0
+
+    async def __aenter__(self):
+        mode = os.O_APPEND if self.append else os.O_TRUNC
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | mode | _O_BINARY, 0o644)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qobuz-writer")
+        self._buf = self.pool.acquire()
+        return self
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            # Slice assignment copies into the preallocated buffer without resizing it
+            n = min(len(view), len(self._buf) - self._fill)
+            self._buf[self._fill:self._fill + n] = view[:n]
+            self._fill += n
+            view = view[n:]
+            if self._fill == len(self._buf):
+                await self._flush()
+
+    async def _flush(self):
+        buf, fill = self._buf, self._fill
+        future = self._executor.submit(_write_all, self._fd, memoryview(buf)[:fill])
+        self._pending.append((asyncio.wrap_future(future), buf))
+        self._buf, self._fill = self.pool.acquire(), 0
+        if len(self._pending) >= self.depth:
+            await self._wait_oldest()
+
+    async def _wait_oldest(self):
+        future, buf = self._pending.popleft()
+        await future
+        self.pool.release(buf)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None and self._fill:
+            await self._flush()
+        # The single worker runs jobs in order, so os.close is queued behind the
+        # outstanding writes and the fd is never closed under a running write
+        closing = self._executor.submit(os.close, self._fd)
+        self._executor.shutdown(wait=False)
+        if exc_type is None:
+            while self._pending:
+                await self._wait_oldest()
+            await asyncio.wrap_future(closing)
+            self.pool.release(self._buf)
+
+class QobuzDownloader:
+    def __init__(self, client: QobuzClient, download_base_path="./downloads", quality=6, max_concurrent=4, save_cover=False):
+        self.client = client
+        self.base_path = download_base_path
+        self.quality = quality
+        # Covers are kept in memory for tagging/thumbnails; only write cover.jpg when asked to
+        self.save_cover = save_cover
+        # Caps how many tracks of an album are fetched from Qobuz at once
+        self._sem = asyncio.Semaphore(max_concurrent)
+        self._buffers = _BufferPool()
+        # One pooled HTTP/2 client for track streams and covers, so connections are reused
+        # and concurrent requests to the same CDN host multiplex over one TLS session
+        self.http = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=2,
+                verify=_SSL_CONTEXT,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+            ),
+            timeout=httpx.Timeout(30.0, connect=10.0)
+        )
+        # album_id -> task resolving to that album's cover bytes / thumbnail path
+        self._cover_cache = {}
+        self._thumb_cache = {}
+        # album_id -> precomputed album-level tag values
+        self._tags_cache = {}
+        os.makedirs(self.base_path, exist_ok=True)
+
+    async def download_track(self, track_id, album_data=None, folder_path=None, pbar_callback=None, existing=None, limiter=None, quality=None, track_data=None):
+        """Download a single track.
+
+        `existing` maps the file names already in `folder_path` to their sizes. download_album
+        passes it so the folder is created and listed once for the whole album.
+        `limiter` (download_album's semaphore) is only held while talking to Qobuz,
+        so the next track can start transferring while this one is being tagged.
+        `quality` overrides self.quality for this call, so concurrent users don't race on it.
+        `track_data` can be an item of album_data["tracks"]["items"], which already has
+        everything needed for naming and tagging, so no track/get request is made.
+        """
+        quality = quality or self.quality
+        async with limiter or contextlib.nullcontext():
+            if track_data is None:
+                # Track meta and download URL are independent requests, fetch them together
+                track_data, file_info = await asyncio.gather(
+                    self.client.get_track(track_id),
+                    self.client.get_file_url(track_id, quality)
+                )
+            else:
+                file_info = await self.client.get_file_url(track_id, quality)
+            if not album_data:
+                album_data = track_data["album"]
+
+            url = file_info.get("url")
+            if not url:
+                raise Exception("No download URL available. It might be a demo or restricted.")
+
+            # Prepare paths
+            artist_name = album_data["artist"]["name"]
+            if not folder_path:
+                folder_path = self._album_folder(album_data)
+
+            is_mp3 = int(quality) == 5
+            extension = ".mp3" if is_mp3 else ".flac"
+            
+            track_number = f"{track_data['track_number']:02}"
+            track_title = metadata_utils.get_title(track_data)
+            filename = _sanitize_filename(f"{track_number}. {track_title}{extension}")
+            final_path = os.path.join(folder_path, filename)
+            # Temp
+            tmp_path = final_path + ".tmp"
+
+            if existing is None:
+                os.makedirs(folder_path, exist_ok=True)
+                try:
+                    already_downloaded = os.stat(final_path).st_size > 0
+                except FileNotFoundError:
+                    already_downloaded = False
+            else:
+                already_downloaded = existing.get(filename, 0) > 0
+
+            if already_downloaded:
+                logger.info(f"File already exists: {filename}")
+                cover = await self._download_cover(album_data, folder_path)
+            else:
+                # Fetch the cover in the background while the track streams
+                cover_task = asyncio.create_task(self._download_cover(album_data, folder_path))
+
+                # Start download
+                try:
+                    await self._stream_to_file(url, tmp_path, filename, pbar_callback)
+                except BaseException:
+                    cover_task.cancel()
+                    raise
+
+                cover = await cover_task
+
+        cover_path = os.path.join(folder_path, "cover.jpg") if cover and self.save_cover else None
+        # Thumbnail only depends on the cover, build it while the track is tagged
+        thumb_task = asyncio.create_task(self._create_thumbnail(album_data, cover, folder_path))
+
+        info = None
+        if not already_downloaded:
+            # Tag the downloaded file in place, then publish it under its final name.
+            # os.replace is atomic, so final_path only ever holds a complete, tagged file.
+            # tag_flac hands back the stream info it parsed anyway (tag_mp3 returns None).
+            info = await asyncio.to_thread(
+                metadata_utils.tag_mp3 if is_mp3 else metadata_utils.tag_flac,
+                tmp_path, track_data, album_data, cover_bytes=cover, album_tags=self._album_tags(album_data)
+            )
+            os.replace(tmp_path, final_path)
+        
+        # Both read files and decode, keep them off the event loop
+        caption, thumb_path = await asyncio.gather(
+            asyncio.to_thread(metadata_utils.get_audio_info, final_path, info),
+            thumb_task
+        )
+        
+        player_info = {
+            "title": track_title,
+            "performer": artist_name,
+            "duration": track_data.get("duration"),
+            "cover": cover_path,
+            "thumbnail": thumb_path,
+            "folder_path": folder_path
+        }
+        
+        return final_path, caption, player_info
+
+    async def _stream_to_file(self, url, tmp_path, filename, pbar_callback=None):
+        """Stream `url` into `tmp_path`, resuming a partial file left by an earlier run."""
+        # The sidecar records the full size, so a leftover .tmp can be validated and resumed
+        meta_path = tmp_path + ".meta"
+        start, expected = 0, None
+        if os.path.exists(tmp_path) and os.path.exists(meta_path):
+            try:
+                with open(meta_path) as f:
+                    expected = int(f.read())
+                start = os.path.getsize(tmp_path)
+            except (OSError, ValueError):
+                start, expected = 0, None
+            if expected is not None and start == expected:
+                logger.info(f"Partial download already complete: {filename}")
+                os.remove(meta_path)
+                return
+            if expected is not None and start > expected:
+                start = 0
+
+        while True:
+            # No transfer compression: sizes and ranges must count the bytes that end up on disk
+            headers = {"Accept-Encoding": "identity"}
+            if start:
+                headers["Range"] = f"bytes={start}-"
+            async with self.http.stream("GET", url, headers=headers) as response:
+                if start and response.status_code == 416:
+                    # The file shrank below the partial download, start over
+                    start = 0
+                    continue
+                response.raise_for_status()
+                if start:
+                    if response.status_code == 206 and _range_total(response) != expected:
+                        # The file changed since the partial download, start over
+                        start = 0
+                        continue
+                    if response.status_code != 206:
+                        # Range was ignored, the body is the whole file
+                        start = 0
+                    else:
+                        logger.info(f"Resuming {filename} from byte {start}")
+
+                total_size = start + int(response.headers.get("content-length", 0))
+                if not start:
+                    if total_size:
+                        with open(meta_path, "w") as f:
+                            f.write(str(total_size))
+                    elif os.path.exists(meta_path):
+                        os.remove(meta_path)
+                reported_at, reported_bytes = 0.0, start
+
+                async with _FileWriter(tmp_path, self._buffers, append=bool(start)) as writer:
+                    async for chunk in response.aiter_bytes():
+                        await writer.write(chunk)
+                        if pbar_callback:
+                            # Throttled, a Telegram message edit per network read would hit rate limits.
+                            # httpx already counts received bytes, so no per-chunk bookkeeping here.
+                            now = time.monotonic()
+                            downloaded = start + response.num_bytes_downloaded
+                            if now - reported_at >= _PROGRESS_INTERVAL or downloaded - reported_bytes >= _PROGRESS_BYTES:
+                                await pbar_callback(downloaded, total_size, filename)
+                                reported_at, reported_bytes = now, downloaded
+                if pbar_callback and start + response.num_bytes_downloaded != reported_bytes:
+                    await pbar_callback(start + response.num_bytes_downloaded, total_size, filename)
+            break
+
+        if total_size:
+            if os.path.getsize(tmp_path) != total_size:
+                raise Exception(f"Incomplete download of {filename}, it will resume on retry")
+            os.remove(meta_path)
+
+    async def _download_cover(self, album_data, folder_path):
+        """Fetch the album cover bytes once and share them between all tracks of the album."""
+        return await self._shared(
+            self._cover_cache, album_data.get("id"),
+            lambda: self._fetch_cover(album_data, folder_path),
+            maxsize=_COVER_CACHE_SIZE
+        )
+
+    async def _create_thumbnail(self, album_data, cover, folder_path):
+        """Build the Telegram thumbnail once per album, in a worker thread."""
+        return await self._shared(
+            self._thumb_cache, album_data.get("id"),
+            lambda: self._make_thumbnail(cover, os.path.join(folder_path, "thumb.jpg"))
+        )
+
+    @staticmethod
+    async def _make_thumbnail(cover, thumb_path):
+        try:
+            return await asyncio.to_thread(metadata_utils.create_thumbnail, cover, thumb_path)
+        except Exception as e:
+            logger.warning(f"Failed to create thumbnail: {e}")
+            return None
+
+    def _album_tags(self, album_data):
+        """Album-level tag values, formatted once per album instead of once per track."""
+        key = album_data.get("id")
+        tags = self._tags_cache.get(key)
+        if tags is None:
+            tags = metadata_utils.precompute_album_tags(album_data)
+            if key is not None:
+                self._tags_cache[key] = tags
+                if len(self._tags_cache) > _CACHE_SIZE:
+                    self._tags_cache.pop(next(iter(self._tags_cache)))
+        return tags
+
+    async def _shared(self, cache, key, factory, maxsize=_CACHE_SIZE):
+        """Run `factory()` once per key and let concurrent callers await the same task."""
+        if key is None:
+            return await factory()
+
+        task = cache.get(key)
+        if task is None or (task.done() and not self._is_usable(task)):
+            task = asyncio.create_task(factory())
+            cache[key] = task
+            if len(cache) > maxsize:
+                cache.pop(next(iter(cache)))
+        # shield so one cancelled track doesn't cancel the work for the others
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def _is_usable(task):
+        if task.cancelled() or task.exception():
+            return False
+        result = task.result()
+        if isinstance(result, str):
+            # The album folder is removed after sending, so a cached path is only
+            # reusable while its file is still on disk
+            return os.path.exists(result)
+        return bool(result)
+
+    async def _fetch_cover(self, album_data, folder_path):
+        cover_path = os.path.join(folder_path, "cover.jpg")
+        if os.path.exists(cover_path):
+            async with aiofiles.open(cover_path, "rb") as f:
+                return await f.read()
+            
+        base_url = album_data["image"]["large"] # Usually 600x600
+        # List of URLs to try in order of preference
+        urls_to_try = [
+            base_url.replace("_600.jpg", "_org.jpg"),  # Original
+            base_url,                                  # 600px
+            album_data["image"]["small"]               # fallback
+        ]
+        urls_to_try = list(dict.fromkeys(url for url in urls_to_try if url))
+        
+        # Request every candidate at once and keep the best one that succeeds, so a
+        # missing original doesn't cost a full round trip before the fallbacks
+        requests = [asyncio.create_task(self.http.get(url, timeout=10.0)) for url in urls_to_try]
+        try:
+            for url, request in zip(urls_to_try, requests):
+                try:
+                    resp = await request
+                    if resp.status_code == 200:
+                        if self.save_cover:
+                            async with aiofiles.open(cover_path, "wb") as f:
+                                await f.write(resp.content)
+                        logger.info(f"Downloaded cover art: {url}")
+                        return resp.content
+                except Exception as e:
+                    logger.debug(f"Failed to download cover from {url}: {e}")
+        finally:
+            for request in requests:
+                request.cancel()
+            await asyncio.gather(*requests, return_exceptions=True)
+        
+        logger.warning("Failed to download any cover art")
+        return None
+
+    def _album_folder(self, album_data):
+        artist_name = album_data["artist"]["name"]
+        album_title = album_data["title"]
+        year = album_data.get("release_date_original", "").split("-")[0]
+        folder_name = _sanitize_filename(f"{artist_name} - {album_title} ({year})")
+        return os.path.join(self.base_path, folder_name)
+
+    async def download_album(self, album_id, pbar_callback=None):
+        """Download an entire album."""
+        album_data = await self.client.get_album(album_id)
+        tracks = album_data["tracks"]["items"]
+        folder_path = self._album_folder(album_data)
+
+        # Create and list the folder once instead of stat-ing it from every track
+        os.makedirs(folder_path, exist_ok=True)
+        with os.scandir(folder_path) as entries:
+            existing = {entry.name: entry.stat(follow_symlinks=False).st_size for entry in entries}
+        
+        # gather keeps the results in the album's track order
+        results = await asyncio.gather(*[
+            self.download_track(track["id"], album_data, folder_path, pbar_callback, existing, limiter=self._sem, track_data=track)
+            for track in tracks
+        ], return_exceptions=True)
+
+        downloaded_data = []
+        for track, result in zip(tracks, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to download track {track['title']}: {result}")
+            else:
+                downloaded_data.append(result)
+        
+        return downloaded_data
+
+    async def close(self):
+        await self.http.aclose()
@@ -0,0 +1,15 @@
+"""Bot texts, one module per language, imported the first time a language is used."""
+import importlib
+
+LANGS = ("ru", "en")
+
+class _Texts(dict):
+    """lang -> texts module, so TEXTS[lang].start works like before."""
+
+    def __missing__(self, lang):
+        if lang not in LANGS:
+            raise KeyError(lang)
+        module = self[lang] = importlib.import_module(f"{__name__}.{lang}")
+        return module
+
+TEXTS = _Texts()
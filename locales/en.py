@@ -0,0 +1,32 @@
+"""English texts."""
+
+start = "👋 Hi! I'm a Qobuz downloader bot.\n\n🔍 Just send me a track name, album name, or a Qobuz link.\n⚙️ Settings: /settings\n\nExample: `Imagine Dragons Believer`"
+settings_title = "⚙️ Settings:"
+quality_menu = "🔈 Audio Quality"
+lang_menu = "🌐 Language / Язык"
+lang_select = "Select language / Выберите язык:"
+quality_select = "Select download quality:"
+searching = "🔍 Searching Qobuz..."
+no_results = "😢 No results found."
+search_results = "🔍 Results for \"{query}\" (Page {page}):"
+loading_track = "🚀 Downloading track..."
+loading_album = "🚀 Downloading album..."
+album_sent = "✅ Album sent successfully!"
+error = "❌ Error occurred: {e}"
+back = "⬅️"
+forward = "➡️"
+downloading = "⏳ Downloading {type}..."
+done = "✅ Download complete!"
+lang_updated = "✅ Language updated!"
+quality_updated = "✅ Quality updated!"
+artist_profile = "👤 Artist: {name}\n📀 Albums: {count}"
+discography = "📀 Discography"
+albums_of = "Albums of {name} (Page {page}):"
+category_albums = "📀 Albums"
+category_singles = "🎵 Singles/EP"
+category_compilations = "📚 Other"
+artist_info = "👤 **{name}**\n\nTotal releases: {count}"
+album_info = "💽 **{title}**\n👤 {artist}\n📅 {year}\n\nTracks list:"
+download_full_album = "📥 Download Full Album"
+tracks_list = "🎵 Tracks ({page}):"
+expired = "⌛ This menu has expired, please search again."
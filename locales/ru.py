@@ -0,0 +1,32 @@
+"""Russian texts."""
+
+start = "👋 Привет! Я бот для скачивания музыки из Qobuz.\n\n🔍 Просто отправь мне название песни, альбома или ссылку на Qobuz.\n⚙️ Настройки: /settings\n\nНапример: `Roni Size - Share The Fall`"
+settings_title = "⚙️ Настройки:"
+quality_menu = "🔈 Качество звука"
+lang_menu = "🌐 Язык / Language"
+lang_select = "Выберите язык / Select language:"
+quality_select = "Выберите качество загрузки:"
+searching = "🔍 Ищу в Qobuz..."
+no_results = "😢 Ничего не найдено."
+search_results = "🔍 Результаты для \"{query}\" (Стр. {page}):"
+loading_track = "🚀 Загружаю трек..."
+loading_album = "🚀 Загрузка альбома..."
+album_sent = "✅ Альбом успешно отправлен!"
+error = "❌ Произошла ошибка: {e}"
+back = "⬅️"
+forward = "➡️"
+downloading = "⏳ Начинаю загрузку {type}..."
+done = "✅ Загрузка завершена!"
+lang_updated = "✅ Язык изменен!"
+quality_updated = "✅ Качество обновлено!"
+artist_profile = "👤 Артист: {name}\n📀 Альбомов: {count}"
+discography = "📀 Дискография"
+albums_of = "Альбомы {name} (Стр. {page}):"
+category_albums = "📀 Альбомы"
+category_singles = "🎵 Синглы/EP"
+category_compilations = "📚 Другое"
+artist_info = "👤 **{name}**\n\nВсего релизов: {count}"
+album_info = "💽 **{title}**\n👤 {artist}\n📅 {year}\n\nСписок треков:"
+download_full_album = "📥 Скачать весь альбом"
+tracks_list = "🎵 Треки ({page}):"
+expired = "⌛ Это меню устарело, повторите поиск."
@@ -0,0 +1,34 @@
+import pytest
+from pathvalidate import sanitize_filename
+
+from downloader import _sanitize_filename
+
+@pytest.mark.parametrize("name", [
+    "01. Song.flac",
+    "Artist - Album (2020)",
+    "AC/DC - Back In Black (1980)",
+    'What? "Live" <Remastered>: Part 1|2*',
+    "a\x7fb",
+    "tab\there\x00\x1f",
+    " leading.flac",
+    "  both ends  ",
+    "trailing dots...",
+    "trailing . .",
+    ".hidden",
+    " . ",
+    "...",
+    "nul",
+    "nul ",
+    " nul",
+    "NUL.flac",
+    "con.",
+    "com1.mp3",
+    "Clock$",
+    "Connie - Album (1999)",
+    "",
+    "\x00",
+    "x" * 300,
+    "Sigur Rós - ( ) (2002)",
+])
+def test_sanitize_filename_matches_pathvalidate(name):
+    assert _sanitize_filename(name) == sanitize_filename(name)